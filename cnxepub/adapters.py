@@ -6,34 +6,23 @@
 # See LICENCE.txt for details.
 # ###
 from __future__ import unicode_literals
-import sys
 import base64
-import io
 import logging
 import mimetypes
-import os
 import uuid
-import re
-
 from copy import deepcopy
-
-import jinja2
-import lxml.html
+import re
 
 from lxml import etree
 
-from .formatters import HTMLFormatter
 from .models import (
-    flatten_model, flatten_to_documents,
-    content_to_etree, etree_to_content,
+    flatten_model,
+    content_to_etree,
     Binder, TranslucentBinder,
-    Document, DocumentPointer, CompositeDocument,
-    TRANSLUCENT_BINDER_ID,
-    INTERNAL_REFERENCE_TYPE,
-    INLINE_REFERENCE_TYPE,
+    Document, CompositeDocument,
+    xml_parser,
     )
 from .html_parsers import (parse_metadata, parse_navigation_html_to_tree,
-                           parse_resources, DocumentPointerMetadataParser,
                            HTML_DOCUMENT_NAMESPACES)
 
 logger = logging.getLogger('cnxepub')
@@ -47,11 +36,17 @@ __all__ = (
 
 def get_model_extensions(binder):
     extensions = {}
+    # Most models share a handful of media-types, so each is looked up once.
+    media_type_extensions = {}
     # Set model identifier file extensions.
     for model in flatten_model(binder):
         if isinstance(model, (Binder, TranslucentBinder,)):
             continue
-        ext = mimetypes.guess_extension(model.media_type, strict=False)
+        try:
+            ext = media_type_extensions[model.media_type]
+        except KeyError:
+            ext = media_type_extensions[model.media_type] = \
+                mimetypes.guess_extension(model.media_type, strict=False)
         if ext is None:
             raise ValueError("Can't apply an extension to media-type '{}'."
                              .format(model.media_type))
@@ -63,40 +58,62 @@ def get_model_extensions(binder):
 def adapt_single_html(html):
     """Adapts a single html document generated by
     ``.formatters.SingleHTMLFormatter`` to a ``models.Binder``
+    The ``html`` may be given as text or as an already parsed etree object,
+    which is left unchanged.
     """
-    html_root = etree.fromstring(html)
+    if isinstance(html, (str, bytes)):
+        return _adapt_single_html(etree.fromstring(html, xml_parser()))
+    if hasattr(html, 'getroot'):
+        html = html.getroot()
+    return _adapt_single_html(deepcopy(html))
+
 
-    metadata = parse_metadata(html_root.xpath('//*[@data-type="metadata"]')[0])
+def _adapt_single_html(html_root):
+    """Adapts the single html document ``html_root`` (an etree element),
+    moving its pages into the documents of the returned binder.
+    """
+    metadata_elem = html_root.find('.//*[@data-type="metadata"]')
+    if metadata_elem is None:
+        raise ValueError('single-HTML has no metadata section')
+    metadata = parse_metadata(metadata_elem)
     id_ = metadata['cnx-archive-uri'] or 'book'
 
     binder = Binder(id_, metadata=metadata)
     nav_tree = parse_navigation_html_to_tree(html_root, id_)
 
-    body = html_root.xpath('//xhtml:body', namespaces=HTML_DOCUMENT_NAMESPACES)
-    _adapt_single_html_tree(binder, body[0], nav_tree, top_metadata=metadata)
+    body = html_root.find('.//xhtml:body', namespaces=HTML_DOCUMENT_NAMESPACES)
+    if body is None:
+        raise ValueError('single-HTML has no body')
+    _adapt_single_html_tree(binder, body, nav_tree, top_metadata=metadata)
 
     return binder
 
 
-def _adapt_single_html_tree(parent, elem, nav_tree, top_metadata,
-                            id_map=None, depth=0):
-    title_overrides = [i.get('title') for i in nav_tree['contents']]
-
+def _adapt_single_html_tree(book, elem, nav_tree, top_metadata):
     # A dictionary to allow look up of a document and new id using the old html
     # element id
-
-    if id_map is None:
-        id_map = {}
+    id_map = {}
+    # Each page with the intra-book links found while fixing its ids
+    page_links = []
 
     def fix_generated_ids(page, id_map):
-        """Fix element ids (remove auto marker) and populate id_map."""
+        """Fix element ids (remove auto marker) and populate id_map.
+        The same walk collects the page's intra-book links, which are
+        returned for ``fix_links`` to remap once the whole book is done.
+        """
 
-        content = content_to_etree(page.content)
+        content = page._xml
 
         new_ids = set()
         suffix = 0
-        for element in content.xpath('.//*[@id]'):
+        links = []
+        for element in content.iterdescendants(etree.Element):
+            href = element.get('href')
+            if href is not None and href.startswith('#'):
+                links.append(element)
             id_val = element.get('id')
+            if id_val is None:
+                continue
             if id_val.startswith('auto_'):
                 # It's possible that an auto_ prefix was injected using a page
                 # ID that incorporated the page_ prefix. We'll remove that
@@ -128,16 +145,13 @@ def _adapt_single_html_tree(parent, elem, nav_tree, top_metadata,
         id_map['#{}'.format(page.id)] = (page, '')
         assert not (page.id and '@' in page.id)
         id_map['#{}'.format(page.id.split('@')[0])] = (page, '')
+        return links
 
-        page.content = etree_to_content(content)
+    def fix_links(page, links, id_map):
+        """Remap the intra-book links of a page with values from id_map."""
 
-    def fix_links(page, id_map):
-        """Remap all intra-book links, replace with value from id_map."""
-
-        content = content_to_etree(page.content)
-        for i in content.xpath('.//*[starts-with(@href, "#")]',
-                               namespaces=HTML_DOCUMENT_NAMESPACES):
-            ref_val = i.attrib['href']
+        for i in links:
+            ref_val = i.get('href')
             if ref_val in id_map:
                 target_page, target = id_map[ref_val]
                 if page == target_page:
@@ -152,10 +166,15 @@ def _adapt_single_html_tree(parent, elem, nav_tree, top_metadata,
             else:
                 logger.error('Bad href: {}'.format(ref_val))
 
-        page.content = etree_to_content(content)
+    # Parent uuids by parent identity; every child without an id needs one.
+    parent_uuids = {}
 
-    def _compute_id(p, elem, key):
-        """Compute id and shortid from parent uuid and child attr"""
+    def _parent_uuid(p):
+        """Find the uuid of parent ``p``, parsing it once per parent"""
+        try:
+            return parent_uuids[id(p)]
+        except KeyError:
+            pass
         p_ids = [p.id.split('@')[0]]
         if 'cnx-archive-uri' in p.metadata and p.metadata['cnx-archive-uri']:
             p_ids.insert(0, p.metadata['cnx-archive-uri'].split('@')[0])
@@ -168,6 +187,12 @@ def _adapt_single_html_tree(parent, elem, nav_tree, top_metadata,
             except ValueError:
                 pass
 
+        parent_uuids[id(p)] = p_uuid
+        return p_uuid
+
+    def _compute_id(p, elem, key):
+        """Compute id and shortid from parent uuid and child attr"""
+        p_uuid = _parent_uuid(p)
         assert p_uuid is not None, 'Should always find a parent UUID'
         uuid_key = elem.get('data-uuid-key', elem.get('class', key))
         return str(uuid.uuid5(p_uuid, uuid_key))
@@ -185,16 +210,43 @@ def _adapt_single_html_tree(parent, elem, nav_tree, top_metadata,
         else:
             return shortid
 
+    def _frame(parent, elem, nav_tree):
+        """Prepare to adapt the children of ``elem`` into ``parent``."""
+        title_overrides = [i.get('title') for i in nav_tree['contents']]
+        nav_items = iter(nav_tree['contents'])
+        # Pages and titles are moved out of ``elem`` while it is walked.
+        return parent, iter(list(elem)), nav_items, title_overrides
+
+    def _next_nav_item(nav_items):
+        """Take the navigation entry for the next node element."""
+        nav_item = next(nav_items, None)
+        if nav_item is None:
+            raise IndexError('Nav TOC has fewer entries than the HTML '
+                             'structure has nodes')
+        return nav_item
+
     # Adapt each <div data-type="unit|chapter|page|composite-page"> into
-    # translucent binders, documents and composite documents
-    for child in elem.getchildren():
-        data_type = child.attrib.get('data-type')
+    # translucent binders, documents and composite documents. There is a
+    # frame on the stack for each binder being filled.
+    stack = [_frame(book, elem, nav_tree)]
+    while stack:
+        parent, children, nav_items, title_overrides = stack[-1]
+        child = next(children, None)
+        if child is None:
+            stack.pop()
+            assert len(parent) == len(title_overrides), \
+                'Nav TOC should HTML structure'
+            for i, node in enumerate(parent):
+                parent.set_title_for_node(node, title_overrides[i])
+            continue
+
+        data_type = child.get('data-type')
 
         if data_type in ('unit', 'chapter', 'composite-chapter',
                          'page', 'composite-page'):
             # metadata munging for all node types, in one place
             metadata = parse_metadata(
-                    child.xpath('./*[@data-type="metadata"]')[0])
+                    child.findall('*[@data-type="metadata"]')[0])
 
             # Handle version, id and uuid from metadata
             if not metadata.get('version'):
@@ -205,7 +257,7 @@ def _adapt_single_html_tree(parent, elem, nav_tree, top_metadata,
                     metadata['version'] = parent.metadata['version']
 
             uuid_key = child.get('data-uuid-key')
-            child_id = child.attrib.get('id')
+            child_id = child.get('id')
             id_ = metadata.get('cnx-archive-uri') or (child_id
                                                       if not uuid_key
                                                       else None)
@@ -225,56 +277,50 @@ def _adapt_single_html_tree(parent, elem, nav_tree, top_metadata,
 
         if data_type in ['unit', 'chapter', 'composite-chapter']:
             # All the non-leaf node types
-            title = lxml.html.HtmlElement(
-                        child.xpath('*[@data-type="document-title"]',
-                                    namespaces=HTML_DOCUMENT_NAMESPACES)[0]
-                        ).text_content().strip()
+            # The title is taken out of the node, so it isn't mistaken
+            # for a child node below.
+            title_elem = child.find('*[@data-type="document-title"]')
+            if title_elem is None:
+                raise IndexError('{} {} has no document-title'.format(
+                    data_type, child_id or id_))
+            child.remove(title_elem)
+            title = ''.join(title_elem.itertext()).strip()
             metadata.update({'title': title,
                              'id': id_,
                              'shortId': shortid,
                              'type': data_type})
             binder = Binder(id_, metadata=metadata)
-            # Recurse
-            _adapt_single_html_tree(binder, child,
-                                    nav_tree['contents'].pop(0),
-                                    top_metadata=top_metadata,
-                                    id_map=id_map, depth=depth+1)
             parent.append(binder)
+            # Descend
+            stack.append(_frame(binder, child, _next_nav_item(nav_items)))
         elif data_type in ['page', 'composite-page']:
             # Leaf nodes
-            nav_tree['contents'].pop(0)
-            metadata_nodes = child.xpath("*[@data-type='metadata']",
-                                         namespaces=HTML_DOCUMENT_NAMESPACES)
+            _next_nav_item(nav_items)
+            metadata_nodes = child.findall("*[@data-type='metadata']")
             for node in metadata_nodes:
                 child.remove(node)
-            for key in child.keys():
-                assert key not in ('itemtype', 'itemscope'), 'Seems true'
+            assert child.get('itemtype') is None and \
+                child.get('itemscope') is None, 'Seems true'
 
             document_body = content_to_etree('')
             document_body.append(child)
-            contents = etree.tostring(document_body)
             model = {
                 'page': Document,
                 'composite-page': CompositeDocument,
-                }[child.attrib['data-type']]
+                }[data_type]
 
-            document = model(id_, contents, metadata=metadata)
+            document = model(id_, document_body, metadata=metadata)
             parent.append(document)
 
-            fix_generated_ids(document, id_map)  # also populates id_map
+            # also populates id_map
+            page_links.append((document, fix_generated_ids(document, id_map)))
         else:
             assert data_type in ['metadata', None], \
                 'Unknown data-type for child node'
             # Expected non-nodal child types
             pass
 
-    assert len(parent) == len(title_overrides), 'Nav TOC should HTML structure'
-
-    for i, node in enumerate(parent):
-        parent.set_title_for_node(node, title_overrides[i])
-
     # only fixup links after all pages
     # processed for whole book, to allow for foward links
-    if depth == 0:
-        for page in flatten_to_documents(parent):
-            fix_links(page, id_map)
+    for page, links in page_links:
+        fix_links(page, links, id_map)
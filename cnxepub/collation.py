@@ -8,15 +8,15 @@
 
 from lxml import etree
 
-from .adapters import adapt_single_html
+from .adapters import _adapt_single_html
+from .models import xml_parser
 
 
 def reconstitute(html):
     """Given a file-like object as ``html``, reconstruct it into models."""
     html.seek(0)
-    htree = etree.parse(html)
-    xhtml = etree.tostring(htree, encoding='utf-8')
-    return adapt_single_html(xhtml)
+    htree = etree.parse(html, xml_parser())
+    return _adapt_single_html(htree.getroot())
 
 
 __all__ = (
@@ -6,27 +6,25 @@
 # See LICENCE.txt for details.
 # ###
 from __future__ import unicode_literals
-import hashlib
-import json
 import logging
 import sys
-from io import BytesIO
 
 import re
 import jinja2
 import lxml.html
 from lxml import etree
 from copy import deepcopy
+from functools import lru_cache
 
 import requests
 
 from .models import (
-    model_to_tree, content_to_etree, etree_to_content,
+    model_to_tree, etree_to_content,
     flatten_to_documents,
     Binder, TranslucentBinder,
-    Document, DocumentPointer, CompositeDocument, utf8)
+    Document, DocumentPointer, CompositeDocument, utf8, xml_parser)
 from .html_parsers import HTML_DOCUMENT_NAMESPACES
-from .utils import ThreadPoolExecutor
+from .utils import ThreadPoolExecutor, thread_local_parser
 from .templates.exercise_template import EXERCISE_TEMPLATE
 
 logger = logging.getLogger('cnxepub')
@@ -34,6 +32,47 @@ logger = logging.getLogger('cnxepub')
 IS_PY3 = sys.version_info.major == 3
 
 
+def _isdict(v):
+    return isinstance(v, dict)
+
+
+# Shared by every formatter.
+TEMPLATE_ENV = jinja2.Environment(trim_blocks=True, lstrip_blocks=True)
+TEMPLATE_ENV.globals['isdict'] = _isdict
+
+
+def _fragment_parser():
+    """The parser for summaries and fetched exercises. Unlike
+    ``xml_parser()`` it keeps libxml2's size and depth limits, since the
+    input is not book content.
+    """
+    return thread_local_parser(collect_ids=False)
+
+
+@lru_cache(maxsize=256)
+def _compile_xpath(path):
+    """Compile the XPath ``path``, with the xhtml namespaces, once and
+    reuse it thereafter.
+    """
+    return etree.XPath(path, namespaces=HTML_DOCUMENT_NAMESPACES)
+
+
+# Used by ``HTMLFormatter._generate_ids`` on every page that it renders.
+EXISTING_IDS_XPATH = etree.XPath('//*/@id')
+ID_ELEMENTS_XPATH = etree.XPath('.//*[@id]')
+ANCHORS_XPATH = etree.XPath('//a[@href]|//xhtml:a[@href]',
+                            namespaces=HTML_DOCUMENT_NAMESPACES)
+
+# Rendered documents always have these as direct children of <html>.
+HEAD_TAG = '{{{}}}head'.format(HTML_DOCUMENT_NAMESPACES['xhtml'])
+BODY_TAG = '{{{}}}body'.format(HTML_DOCUMENT_NAMESPACES['xhtml'])
+METADATA_PATH = '{{{}}}div[@data-type="metadata"]'.format(
+    HTML_DOCUMENT_NAMESPACES['xhtml'])
+# Used on every built book and on every included exercise.
+HREF_XPATH = etree.XPath('//*[@href]')
+PARENT_PAGE_XPATH = etree.XPath('ancestor::*[@data-type="page"]')
+
+
 __all__ = (
     'DocumentContentFormatter',
     'DocumentSummaryFormatter',
@@ -80,7 +119,7 @@ class DocumentSummaryFormatter(object):
         # try to make sure summary is wrapped in a tag
         summary = self.document.metadata.get('summary', '') or ''
         try:
-            etree.fromstring(summary)
+            etree.fromstring(summary, _fragment_parser())
             html = '{}'.format(summary)
         except etree.XMLSyntaxError:
             html = """\
@@ -101,13 +140,12 @@ class HTMLFormatter(object):
         """Generate unique ids for html elements in page content so that it's
         possible to link to them.
         """
-        existing_ids = content.xpath('//*/@id')
-        xpath = './/*[@id]'
+        existing_ids = EXISTING_IDS_XPATH(content)
 
         old_id_to_new_id = {}
         # Step 1: prefix all ids with the document so they are unique when all
         # the documents are combined
-        for node in content.xpath(xpath, namespaces=HTML_DOCUMENT_NAMESPACES):
+        for node in ID_ELEMENTS_XPATH(content):
             old_id = node.attrib.get('id')
             document_id = document.id.replace('_', '')
             new_id = 'auto_{}_{}'.format(document_id, old_id)
@@ -116,8 +154,7 @@ class HTMLFormatter(object):
             existing_ids.append(new_id)
 
         # Step 2: redirect links to elements with now prefixed ids
-        for a in content.xpath('//a[@href]|//xhtml:a[@href]',
-                               namespaces=HTML_DOCUMENT_NAMESPACES):
+        for a in ANCHORS_XPATH(content):
             href = a.attrib['href']
             if href.startswith('#') and href[1:] in old_id_to_new_id:
                 a.attrib['href'] = '#{}'.format(old_id_to_new_id[href[1:]])
@@ -131,8 +168,10 @@ class HTMLFormatter(object):
             return tree_to_html(
                 model_to_tree(self.model), self.extensions).decode('utf-8')
         elif isinstance(self.model, Document):
-            _html = content_to_etree(self.model.content)
+            _html = self.model._xml
             if self.generate_ids:
+                # Rewrite the ids on a copy, to leave the document untouched.
+                _html = deepcopy(_html)
                 self._generate_ids(self.model, _html)
 
             return etree_to_content(_html, strip_root_node=True)
@@ -140,15 +179,8 @@ class HTMLFormatter(object):
     @property
     def _template(self):
         if isinstance(self.model, DocumentPointer):
-            return jinja2.Template(DOCUMENT_POINTER_TEMPLATE,
-                                   trim_blocks=True, lstrip_blocks=True)
-
-        def isdict(v):
-            return isinstance(v, dict)
-
-        template_env = jinja2.Environment(trim_blocks=True, lstrip_blocks=True)
-        return template_env.from_string(HTML_DOCUMENT,
-                                        globals={'isdict': isdict})
+            return COMPILED_DOCUMENT_POINTER_TEMPLATE
+        return COMPILED_HTML_DOCUMENT
 
     @property
     def _template_args(self):
@@ -172,19 +204,38 @@ class HTMLFormatter(object):
             return self.__bytes__().decode('utf-8')
         return self.__bytes__()
 
+    def to_etree(self):
+        """Render the model and parse the result to an etree object,
+        for callers that would otherwise reparse the serialized bytes.
+        Its namespaces are cleaned up as they are in those bytes, so that
+        the declarations are in the same order as a reparse would give.
+        """
+        # The rendered chunks are fed to the parser as they are generated.
+        # A feed parser holds state, so each rendering gets its own.
+        parser = etree.XMLParser(collect_ids=False, huge_tree=True)
+        for chunk in self._template.generate(self._template_args):
+            parser.feed(chunk.encode('utf-8'))
+        root = parser.close()
+        _clean_namespaces(root)
+        return root
+
     def __bytes__(self):
-        html = self._template.render(self._template_args)
-        return _fix_namespaces(html.encode('utf-8'))
+        return etree.tostring(self.to_etree(), pretty_print=True,
+                              encoding='utf-8')
 
 
 class SingleHTMLFormatter(object):
     def __init__(self, binder, includes=None, threads=1):
         self.binder = binder
+        # Computed for the whole book and shared with the formatters of its
+        # nested binders.
+        from .adapters import get_model_extensions
+        self.extensions = get_model_extensions(self.binder)
 
-        self.root = etree.fromstring(bytes(HTMLFormatter(self.binder)))
+        self.root = HTMLFormatter(self.binder, self.extensions).to_etree()
 
-        self.head = self.xpath('//xhtml:head')[0]
-        self.body = self.xpath('//xhtml:body')[0]
+        self.head = self.root.find(HEAD_TAG)
+        self.body = self.root.find(BODY_TAG)
 
         self.built = False
         self.includes = includes
@@ -192,9 +243,10 @@ class SingleHTMLFormatter(object):
         self.threads = threads
 
     def xpath(self, path, elem=None):
+        compiled_xpath = _compile_xpath(path)
         if elem is None:
-            elem = self.root
-        return elem.xpath(path, namespaces=HTML_DOCUMENT_NAMESPACES)
+            return compiled_xpath(self.root)
+        return compiled_xpath(elem)
 
     def get_node_type(self, node, parent=None):
         """If node is a document, the type is page.
@@ -228,13 +280,11 @@ class SingleHTMLFormatter(object):
                 attrs['id'] = "%s%s" % (id_prefix, node.id)
             child_elem = etree.SubElement(elem, 'div', **attrs)
             if isinstance(node, TranslucentBinder):
-                html = bytes(HTMLFormatter(node, generate_ids=False))
-                doc_root = etree.fromstring(html)
-                metadata = doc_root.xpath(
-                           '//xhtml:body/xhtml:div[@data-type="metadata"]',
-                           namespaces=HTML_DOCUMENT_NAMESPACES)
-                if metadata:
-                    child_elem.append(metadata[0])
+                doc_root = HTMLFormatter(node, self.extensions,
+                                         generate_ids=False).to_etree()
+                metadata = doc_root.find(BODY_TAG).find(METADATA_PATH)
+                if metadata is not None:
+                    child_elem.append(metadata)
 
                 # And now the top-level title, too
                 etree.SubElement(
@@ -242,10 +292,8 @@ class SingleHTMLFormatter(object):
                       ).text = node.metadata['title']
                 self._build_binder(node, child_elem)
             elif isinstance(node, (Document, DocumentPointer)):
-                html = bytes(HTMLFormatter(node, generate_ids=True))
-                doc_root = etree.fromstring(html)
-                body = doc_root.xpath('//xhtml:body',
-                                      namespaces=HTML_DOCUMENT_NAMESPACES)[0]
+                doc_root = HTMLFormatter(node, generate_ids=True).to_etree()
+                body = doc_root.find(BODY_TAG)
                 for c in body.iterchildren():
                     child_elem.append(c)
                 for a in body.attrib:
@@ -259,16 +307,15 @@ class SingleHTMLFormatter(object):
 
         # Fetch any includes from remote sources
         if not self.included and self.includes is not None:
+            uuids = tuple(page_uuids)
             for match, proc in self.includes:
                 with ThreadPoolExecutor(max_workers=self.threads) as e:
                     for elem in self.xpath(match):
-                        e.submit(
-                            proc, elem, list(page_uuids.keys())
-                        )
+                        e.submit(proc, elem, uuids)
             self.included = True
 
         # Rewrite absolute-path links that are intra-binder
-        for link in self.root.xpath('//*[@href]'):
+        for link in HREF_XPATH(self.root):
             href = link.get('href')
             if href.startswith('/contents/'):
                 link_uuid = re.split('@|#', href[10:])[0]
@@ -295,33 +342,40 @@ class SingleHTMLFormatter(object):
     def __bytes__(self):
         if not self.built:
             self.build()
-        return _fix_namespaces(etree.tostring(self.root,
-                                              pretty_print=True,
-                                              encoding='utf-8'))
+        # The built book is kept as is; its namespaces are cleaned on a copy.
+        return _cleanup_namespaces(deepcopy(self.root))
 
 
 def _fix_namespaces(html):
+    return _cleanup_namespaces(etree.fromstring(html, xml_parser()))
+
+
+# Namespaces declared on the root tag, with these prefixes, when cleaning up.
+ROOT_NSMAP = {None: u"http://www.w3.org/1999/xhtml",
+              u"m": u"http://www.w3.org/1998/Math/MathML",
+              u"epub": u"http://www.idpf.org/2007/ops",
+              u"rdf": u"http://www.w3.org/1999/02/22-rdf-syntax-ns#",
+              u"dc": u"http://purl.org/dc/elements/1.1/",
+              u"lrmi": u"http://lrmi.net/the-specification",
+              u"bib": u"http://bibtexml.sf.net/",
+              u"data":
+                  u"http://www.w3.org/TR/html5/dom.html#custom-data-attribute",
+              u"qml": u"http://cnx.rice.edu/qml/1.0",
+              u"datadev": u"http://dev.w3.org/html5/spec/#custom",
+              u"mod": u"http://cnx.rice.edu/#moduleIds",
+              u"md": u"http://cnx.rice.edu/mdml",
+              u"c": u"http://cnx.rice.edu/cnxml"
+              }
+
+
+def _clean_namespaces(root):
     # Get rid of unused namespaces and put them all in the root tag
-    nsmap = {None: u"http://www.w3.org/1999/xhtml",
-             u"m": u"http://www.w3.org/1998/Math/MathML",
-             u"epub": u"http://www.idpf.org/2007/ops",
-             u"rdf": u"http://www.w3.org/1999/02/22-rdf-syntax-ns#",
-             u"dc": u"http://purl.org/dc/elements/1.1/",
-             u"lrmi": u"http://lrmi.net/the-specification",
-             u"bib": u"http://bibtexml.sf.net/",
-             u"data":
-                 u"http://www.w3.org/TR/html5/dom.html#custom-data-attribute",
-             u"qml": u"http://cnx.rice.edu/qml/1.0",
-             u"datadev": u"http://dev.w3.org/html5/spec/#custom",
-             u"mod": u"http://cnx.rice.edu/#moduleIds",
-             u"md": u"http://cnx.rice.edu/mdml",
-             u"c": u"http://cnx.rice.edu/cnxml"
-             }
-    root = etree.fromstring(html)
-
     # lxml has a built in function to do this without destroying comments
-    etree.cleanup_namespaces(root, top_nsmap=nsmap)
+    etree.cleanup_namespaces(root, top_nsmap=ROOT_NSMAP)
+
 
+def _cleanup_namespaces(root):
+    _clean_namespaces(root)
     return etree.tostring(root, pretty_print=True, encoding='utf-8')
 
 
@@ -356,7 +410,7 @@ def exercise_callback_factory(match, url_template,
         # book, or even invalid altogether. We'll prefer the first, fallback
         # to the second, and error in the last case.
 
-        parent_page_elem = elem.xpath('ancestor::*[@data-type="page"]')[0]
+        parent_page_elem = PARENT_PAGE_XPATH(elem)[0]
         parent_page_uuid = parent_page_elem.get('id')
         if parent_page_uuid.startswith('page_'):
             # Strip `page_` prefix from ID to get UUID
@@ -446,7 +500,8 @@ def exercise_callback_factory(match, url_template,
 
             html = render_exercise(exercise)
             try:
-                nodes = etree.fromstring('<div>{}</div>'.format(html))
+                nodes = etree.fromstring('<div>{}</div>'.format(html),
+                                         _fragment_parser())
             except etree.XMLSyntaxError:  # Probably HTML
                 nodes = etree.HTML(html)[0]  # body node
 
@@ -799,6 +854,31 @@ HTML_DOCUMENT = """\
 </html>
 """
 
+# Compiled at import and shared by every ``HTMLFormatter``.
+COMPILED_DOCUMENT_POINTER_TEMPLATE = TEMPLATE_ENV.from_string(
+    DOCUMENT_POINTER_TEMPLATE)
+COMPILED_HTML_DOCUMENT = TEMPLATE_ENV.from_string(HTML_DOCUMENT)
+
+
+# Characters that only the HTML fragment parser can handle for a title.
+TITLE_MARKUP_CHARS = re.compile(r'[<&\r]')
+
+
+def _title_element(title, tag):
+    """Make a ``tag`` element holding the (possibly marked up) ``title``.
+    Most titles are plain text, so they are set as the element's text
+    without going through the HTML fragment parser.
+    """
+    if title.strip() and not TITLE_MARKUP_CHARS.search(title):
+        elm = etree.Element(tag)
+        try:
+            elm.text = title
+            return elm
+        except ValueError:
+            # Not XML compatible, e.g. control characters.
+            pass
+    return lxml.html.fragment_fromstring(title, create_parent=tag)
+
 
 # YANK This was pulled from cnx-archive to temporarily provide
 #      a way to render the the tree to html. This either needs to
@@ -819,12 +899,10 @@ def html_listify(tree, root_xl_element, extensions, list_type='ol'):
     for node in tree:
         li_elm = etree.SubElement(root_xl_element, 'li')
         if node['id'] not in extensions:  # no extension, no associated file
-            span_elm = lxml.html.fragment_fromstring(
-                node['title'], create_parent='span')
+            span_elm = _title_element(node['title'], 'span')
             li_elm.append(span_elm)
         else:
-            a_elm = lxml.html.fragment_fromstring(
-                node['title'], create_parent='a')
+            a_elm = _title_element(node['title'], 'a')
             a_elm.set('href', ''.join(['#page_', node['id'].split('@')[0]]))
             li_elm.append(a_elm)
         if node['id'] is not None and node['id'] != 'subcol':
@@ -5,7 +5,7 @@
 # Public License version 3 (AGPLv3).
 # See LICENCE.txt for details.
 # ###
-import re
+from functools import lru_cache
 
 from lxml import etree
 
@@ -17,55 +17,151 @@ HTML_DOCUMENT_NAMESPACES = {
     'xhtml': "http://www.w3.org/1999/xhtml",
     'epub': "http://www.idpf.org/2007/ops",
     }
+RESOURCE_LINKS_XPATH = etree.XPath(
+    '//*[@data-type="resources"]//xhtml:li/xhtml:a',
+    namespaces=HTML_DOCUMENT_NAMESPACES)
+LANGUAGE_XPATH = etree.XPath(
+    'ancestor-or-self::*/@lang'
+    ' | ancestor-or-self::*/*[@data-type="language"]/@content')
+# Three cases for location of the license in the metadata stanza:
+#  1. direct child of current node
+#  2. direct child of any ancestor
+#  3. Top of book (occurs when fetching from root)
+LICENSE_XPATH_TEMPLATE = (
+    'ancestor-or-self::*/*[@data-type="metadata"]//*'
+    '[@data-type="license"]/{0}'
+    ' | /xhtml:html/xhtml:body/*[@data-type="metadata"]//*'
+    '[@data-type="license"]/{0}')
+LICENSE_URL_XPATH = etree.XPath(LICENSE_XPATH_TEMPLATE.format('@href'),
+                                namespaces=HTML_DOCUMENT_NAMESPACES)
+LICENSE_TEXT_XPATH = etree.XPath(LICENSE_XPATH_TEMPLATE.format('text()'),
+                                 namespaces=HTML_DOCUMENT_NAMESPACES)
+NAV_TAG = '{{{}}}nav'.format(HTML_DOCUMENT_NAMESPACES['xhtml'])
+NAV_LIST_TAG = '{{{}}}ol'.format(HTML_DOCUMENT_NAMESPACES['xhtml'])
+NAV_ITEM_TAG = '{{{}}}li'.format(HTML_DOCUMENT_NAMESPACES['xhtml'])
+NAV_LINK_TAG = '{{{}}}a'.format(HTML_DOCUMENT_NAMESPACES['xhtml'])
+META_TAG = '{{{}}}meta'.format(HTML_DOCUMENT_NAMESPACES['xhtml'])
+
+
+@lru_cache(maxsize=256)
+def _compile_xpath(expression, namespaces):
+    """Compile the given XPath ``expression`` once and reuse it thereafter.
+    The ``namespaces`` are given as a tuple of items to keep them hashable.
+    """
+    return etree.XPath(expression, namespaces=dict(namespaces))
+
+
+def _index_metadata(xml):
+    """Walk the descendants of ``xml`` (an etree object) once, grouping
+    elements by their ``data-type`` and ``<meta>`` content values by their
+    ``itemprop`` and by the element their ``display-seq`` refines,
+    keeping document order.
+    """
+    if hasattr(xml, 'getroot'):
+        xml = xml.getroot()
+    data_types, itemprops, display_seqs = {}, {}, {}
+    for elm in xml.iterdescendants(etree.Element):
+        data_type = elm.get('data-type')
+        if data_type is not None:
+            data_types.setdefault(data_type, []).append(elm)
+        if elm.tag != META_TAG:
+            continue
+        content = elm.get('content')
+        if content is None:
+            continue
+        itemprop = elm.get('itemprop')
+        if itemprop is not None:
+            itemprops.setdefault(itemprop, []).append(content)
+        refines = elm.get('refines')
+        if refines is not None and elm.get('property') == 'display-seq':
+            display_seqs.setdefault(refines, []).append(content)
+    return data_types, itemprops, display_seqs
+
+
+def _text_nodes(elm):
+    """Equivalent of the ``text()`` XPath step for the given ``elm``."""
+    texts = [elm.text] + [child.tail for child in elm]
+    return [text for text in texts if text is not None]
 
 
 def parse_navigation_html_to_tree(html, id):
     """Parse the given ``html`` (an etree object) to a tree.
     The ``id`` is required in order to assign the top-level tree id value.
     """
-    def xpath(x):
-        return html.xpath(x, namespaces=HTML_DOCUMENT_NAMESPACES)
-    try:
-        value = xpath('//*[@data-type="binding"]/@data-value')[0]
-        is_translucent = value == 'translucent'
-    except IndexError:
-        is_translucent = False
-    if is_translucent:
+    binding, title, nav = _find_navigation_parts(html)
+    if binding == 'translucent':
         id = TRANSLUCENT_BINDER_ID
     tree = {'id': id,
-            'title': xpath('//*[@data-type="document-title"]/text()')[0],
-            'contents': [x for x in _nav_to_tree(xpath('//xhtml:nav')[0])]
+            'title': title,
+            'contents': _nav_to_tree(nav)
             }
     return tree
 
 
+def _find_navigation_parts(html):
+    """Walk the document of ``html`` (an etree object) once to find the
+    binding value, the title and the ``nav`` element, stopping as soon as
+    all three are found.
+    """
+    if hasattr(html, 'getroot'):
+        root = html.getroot()
+    else:
+        root = html.getroottree().getroot()
+    binding = title = nav = None
+    for elm in root.iter(etree.Element):
+        data_type = elm.get('data-type')
+        if binding is None and data_type == 'binding':
+            binding = elm.get('data-value')
+        elif title is None and data_type == 'document-title':
+            texts = _text_nodes(elm)
+            if texts:
+                title = texts[0]
+        if nav is None and elm.tag == NAV_TAG:
+            nav = elm
+        if binding is not None and title is not None and nav is not None:
+            break
+    return binding, title, nav
+
+
 def _nav_to_tree(root):
     """Given an etree containing a navigation document structure
     rooted from the 'nav' element, parse to a tree:
     {'id': <id>|'subcol', 'title': <title>, 'contents': [<tree>, ...]}
+    The tree's top-level contents list is returned.
     """
-    def expath(e, x):
-        return e.xpath(x, namespaces=HTML_DOCUMENT_NAMESPACES)
-    for li in expath(root, 'xhtml:ol/xhtml:li'):
-        is_subtree = bool([e for e in li.getchildren()
-                           if e.tag[e.tag.find('}')+1:] == 'ol'])
-        if is_subtree:
-            # It's a sub-tree and have a 'span' and 'ol'.
-            itemid = li.get('cnx-archive-uri', 'subcol')
-            shortid = li.get('cnx-archive-shortid')
-            yield {'id': itemid,
-                   # Title is wrapped in a span, div or some other element...
-                   'title': squash_xml_to_text(expath(li, '*')[0],
-                                               remove_namespaces=True),
-                   'shortId': shortid,
-                   'contents': [x for x in _nav_to_tree(li)],
-                   }
-        else:
-            # It's a node and should only have an li.
-            a = li.xpath('xhtml:a', namespaces=HTML_DOCUMENT_NAMESPACES)[0]
-            yield {'id': a.get('href'),
-                   'shortid': li.get('cnx-archive-shortid'),
-                   'title': squash_xml_to_text(a, remove_namespaces=True)}
+    contents = []
+    # Sub-trees are walked from a stack of (element, contents) pairs.
+    stack = [(root, contents)]
+    while stack:
+        node, node_contents = stack.pop()
+        items = (li
+                 for ol in node.iterchildren(NAV_LIST_TAG)
+                 for li in ol.iterchildren(NAV_ITEM_TAG))
+        for li in items:
+            is_subtree = li.find(NAV_LIST_TAG) is not None
+            if is_subtree:
+                # It's a sub-tree and have a 'span' and 'ol'.
+                itemid = li.get('cnx-archive-uri', 'subcol')
+                shortid = li.get('cnx-archive-shortid')
+                subtree = {
+                    'id': itemid,
+                    # Title is wrapped in a span, div or some other element...
+                    'title': squash_xml_to_text(
+                        next(li.iterchildren(etree.Element)),
+                        remove_namespaces=True),
+                    'shortId': shortid,
+                    'contents': [],
+                    }
+                node_contents.append(subtree)
+                stack.append((li, subtree['contents']))
+            else:
+                # It's a node and should only have an li.
+                a = li.find(NAV_LINK_TAG)
+                node_contents.append({
+                    'id': a.get('href'),
+                    'shortid': li.get('cnx-archive-shortid'),
+                    'title': squash_xml_to_text(a, remove_namespaces=True)})
+    return contents
 
 
 def parse_metadata(html):
@@ -76,8 +172,7 @@ def parse_metadata(html):
 
 def parse_resources(html):
     """Return a list of resource names found in the html metadata section."""
-    xpath = '//*[@data-type="resources"]//xhtml:li/xhtml:a'
-    for resource in html.xpath(xpath, namespaces=HTML_DOCUMENT_NAMESPACES):
+    for resource in RESOURCE_LINKS_XPATH(html):
         yield {
             'id': resource.get('href'),
             'filename': resource.text.strip(),
@@ -104,15 +199,62 @@ class DocumentMetadataParser:
     def __init__(self, elm_tree, raise_value_error=True):
         self._xml = elm_tree
         self.raise_value_error = raise_value_error
+        self._data_type_index = None
+        self._itemprop_index = None
+        self._display_seq_index = None
 
     def __call__(self):
         return self.metadata
 
     def parse(self, xpath, prefix=""):
-        values = self._xml.xpath(prefix + xpath,
-                                 namespaces=self.namespaces)
+        compiled_xpath = _compile_xpath(prefix + xpath,
+                                        tuple(self.namespaces.items()))
+        values = compiled_xpath(self._xml)
         return values
 
+    def _index(self):
+        """Index the descendants of the parsed element on first use,
+        so repeated lookups do not rewalk the tree.
+        """
+        if self._data_type_index is None:
+            (self._data_type_index, self._itemprop_index,
+             self._display_seq_index) = _index_metadata(self._xml)
+
+    def _find(self, data_type, xhtml_only=True):
+        """Find the elements below the parsed element with the given
+        ``data-type`` value.
+        """
+        self._index()
+        elms = self._data_type_index.get(data_type, [])
+        if xhtml_only:
+            xhtml_prefix = '{{{}}}'.format(self.namespaces['xhtml'])
+            elms = [e for e in elms if e.tag.startswith(xhtml_prefix)]
+        return elms
+
+    def _find_meta_content(self, itemprop):
+        """Find the ``content`` values of the ``<meta>`` elements below the
+        parsed element with the given ``itemprop`` value.
+        """
+        self._index()
+        return self._itemprop_index.get(itemprop, [])
+
+    def _find_display_seq(self, elm_id):
+        """Find the ``display-seq`` values refining the element with
+        the given ``id``.
+        """
+        self._index()
+        return self._display_seq_index.get('#{}'.format(elm_id), [])
+
+    def _find_text(self, data_type, xhtml_only=True):
+        return [text
+                for elm in self._find(data_type, xhtml_only)
+                for text in _text_nodes(elm)]
+
+    def _find_attribute(self, data_type, attribute):
+        values = [elm.get(attribute)
+                  for elm in self._find(data_type)]
+        return [value for value in values if value is not None]
+
     @property
     def metadata(self):
         items = {}
@@ -132,7 +274,7 @@ class DocumentMetadataParser:
 
     @property
     def title(self):
-        items = self.parse('.//*[@data-type="document-title"]/text()')
+        items = self._find_text('document-title', xhtml_only=False)
         try:
             value = items[0]
         except IndexError:
@@ -141,7 +283,7 @@ class DocumentMetadataParser:
 
     @property
     def summary(self):
-        items = self.parse('.//*[@data-type="description"]')
+        items = self._find('description', xhtml_only=False)
         try:
             description = items[0]
             value = squash_xml_to_text(description).encode('utf-8')
@@ -151,7 +293,7 @@ class DocumentMetadataParser:
 
     @property
     def created(self):
-        items = self.parse('.//xhtml:meta[@itemprop="dateCreated"]/@content')
+        items = self._find_meta_content('dateCreated')
         try:
             value = items[0]
         except IndexError:
@@ -162,10 +304,8 @@ class DocumentMetadataParser:
     def revised(self):
         # Grab revised from <meta> if available, otherwise check for a
         # corresponding data item
-        md_items = self.parse(
-            './/xhtml:meta[@itemprop="dateModified"]/@content'
-        )
-        data_items = self.parse('.//xhtml:*[@data-type="revised"]/@data-value')
+        md_items = self._find_meta_content('dateModified')
+        data_items = self._find_attribute('revised', 'data-value')
 
         value = None
         for maybe_item in [md_items, data_items]:
@@ -180,10 +320,7 @@ class DocumentMetadataParser:
     @property
     def language(self):
         # look for lang attribute or schema.org meta tag
-        items = self.parse('ancestor-or-self::*/@lang'
-                           ' | ancestor-or-self::*/*'
-                           '[@data-type="language"]/@content'
-                           )
+        items = LANGUAGE_XPATH(self._xml)
         try:
             value = items[-1]  # nodes returned in tree order, we want nearest
         except IndexError:
@@ -192,26 +329,17 @@ class DocumentMetadataParser:
 
     @property
     def subjects(self):
-        items = self.parse('.//xhtml:*[@data-type="subject"]/text()')
+        items = self._find_text('subject')
         return items
 
     @property
     def keywords(self):
-        items = self.parse('.//xhtml:*[@data-type="keyword"]/text()')
+        items = self._find_text('keyword')
         return items
 
     @property
     def license_url(self):
-        # Three cases for location of metadata stanza:
-        #  1. direct child of current node
-        #  2. direct child of any ancestor
-        #  3. Top of book (occurs when fetching from root)
-        items = self.parse('ancestor-or-self::*/*[@data-type="metadata"]//*'
-                           '[@data-type="license"]/@href'
-                           ' | /xhtml:html/xhtml:body/*'
-                           '[@data-type="metadata"]//*'
-                           '[@data-type="license"]/@href'
-                           )
+        items = LICENSE_URL_XPATH(self._xml)
 
         try:
             value = items[-1]  # doc order, want lowest (nearest)
@@ -221,22 +349,16 @@ class DocumentMetadataParser:
 
     @property
     def license_text(self):
-        # Same as license_url
-        items = self.parse('ancestor-or-self::*/*[@data-type="metadata"]//*'
-                           '[@data-type="license"]/text()'
-                           ' | /xhtml:html/xhtml:body/*'
-                           '[@data-type="metadata"]//*'
-                           '[@data-type="license"]/text()'
-                           )
+        items = LICENSE_TEXT_XPATH(self._xml)
         try:
             value = items[-1]
         except IndexError:
             value = None
         return value
 
-    def _parse_person_info(self, xpath):
+    def _parse_person_info(self, data_type):
         unordered = []
-        for elm in self.parse(xpath):
+        for elm in self._find(data_type):
             elm_id = elm.get('id', None)
             if len(elm) > 0:
                 person_elm = elm[0]
@@ -250,66 +372,57 @@ class DocumentMetadataParser:
             person = {'name': name, 'type': type_, 'id': id_}
             # Meta refinement allows these to be ordered.
             order = None
-            refines_xpath_tmplt = """\
-.//xhtml:meta[@refines="#{}" and @property="display-seq"]/@content"""
             if elm_id is not None:
                 try:
-                    order = self.parse(refines_xpath_tmplt.format(elm_id))[0]
-                except IndexError:
-                    order = 0  # Check for refinement failed, use constant
+                    order = int(self._find_display_seq(elm_id)[0])
+                except (IndexError, ValueError):
+                    # Missing or non-numeric refinement, use constant
+                    order = 0
             unordered.append((order, person,))
-        ordered = sorted(unordered, key=lambda x: x[0])
+        # People without an id can't be refined, so they are placed last.
+        ordered = sorted(unordered, key=lambda x: (x[0] is None, x[0]))
         values = [x[1] for x in ordered]
         return values
 
     @property
     def publishers(self):
-        xpath = './/xhtml:*[@data-type="publisher"]'
-        return self._parse_person_info(xpath)
+        return self._parse_person_info('publisher')
 
     @property
     def editors(self):
-        xpath = './/xhtml:*[@data-type="editor"]'
-        return self._parse_person_info(xpath)
+        return self._parse_person_info('editor')
 
     @property
     def illustrators(self):
-        xpath = './/xhtml:*[@data-type="illustrator"]'
-        return self._parse_person_info(xpath)
+        return self._parse_person_info('illustrator')
 
     @property
     def translators(self):
-        xpath = './/xhtml:*[@data-type="translator"]'
-        return self._parse_person_info(xpath)
+        return self._parse_person_info('translator')
 
     @property
     def copyright_holders(self):
-        xpath = './/xhtml:*[@data-type="copyright-holder"]'
-        return self._parse_person_info(xpath)
+        return self._parse_person_info('copyright-holder')
 
     @property
     def authors(self):
-        xpath = './/xhtml:*[@data-type="author"]'
-        return self._parse_person_info(xpath)
+        return self._parse_person_info('author')
 
     @property
     def cnx_archive_uri(self):
-        items = self.parse(
-            './/xhtml:*[@data-type="cnx-archive-uri"]/@data-value')
+        items = self._find_attribute('cnx-archive-uri', 'data-value')
         if items:
             return items[0]
 
     @property
     def cnx_archive_shortid(self):
-        items = self.parse(
-            './/xhtml:*[@data-type="cnx-archive-shortid"]/@data-value')
+        items = self._find_attribute('cnx-archive-shortid', 'data-value')
         if items:
             return items[0]
 
     @property
     def version(self):
-        items = self.parse(
-            './/xhtml:*[@data-type="cnx-archive-uri"]/@data-value')
+        items = self._find_attribute('cnx-archive-uri', 'data-value')
         if items:
             assert_msg = 'version should have an @ in it data-value="{}"'
             assert '@' in items[0], assert_msg.format(items[0])
@@ -317,27 +430,25 @@ class DocumentMetadataParser:
 
     @property
     def derived_from_uri(self):
-        items = self.parse('.//xhtml:*[@data-type="derived-from"]/@href')
+        items = self._find_attribute('derived-from', 'href')
         if items:
             return items[0]
 
     @property
     def derived_from_title(self):
-        items = self.parse('.//xhtml:*[@data-type="derived-from"]/text()')
+        items = self._find_text('derived-from')
         if items:
             return items[0]
 
     @property
     def canonical_book_uuid(self):
-        items = self.parse(
-            './/xhtml:*[@data-type="canonical-book-uuid"]/@data-value')
+        items = self._find_attribute('canonical-book-uuid', 'data-value')
         if items:
             return items[0]
 
     @property
     def slug(self):
-        items = self.parse(
-            './/xhtml:*[@data-type="slug"]/@data-value')
+        items = self._find_attribute('slug', 'data-value')
         if items:
             return items[0]
 
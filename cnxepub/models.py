@@ -5,15 +5,14 @@
 # Public License version 3 (AGPLv3).
 # See LICENCE.txt for details.
 # ###
-import io
-import hashlib
 import mimetypes
 from collections.abc import MutableSequence
 from urllib.parse import urlparse
-from contextlib import contextmanager
 
 from lxml import etree
 
+from .utils import thread_local_parser
+
 
 __all__ = (
     'TRANSLUCENT_BINDER_ID', 'RESOURCE_HASH_TYPE',
@@ -61,6 +60,8 @@ XML_WRAPPER = u"""\
 </div>"""
 
 XHTML_NS = {'x': 'http://www.w3.org/1999/xhtml'}
+BODY_TAGS = ('body', '{{{}}}body'.format(XHTML_NS['x']))
+HTML_TAGS = ('html', '{{{}}}html'.format(XHTML_NS['x']))
 
 
 def utf8(item):
@@ -75,12 +76,42 @@ def utf8(item):
         return item
 
 
+def content_parser():
+    """The parser for ``content_to_etree``. IDs are not collected into a
+    lookup table because nothing here uses the XPath ``id()`` function.
+    """
+    return thread_local_parser(ns_clean=True, collect_ids=False)
+
+
+def xml_parser():
+    """The parser for whole books and rendered pages, which do not need
+    an ID table either. A single-HTML book can exceed libxml2's default
+    size and depth limits.
+    """
+    return thread_local_parser(collect_ids=False, huge_tree=True)
+
+
 def content_to_etree(content):
+    if isinstance(content, etree._Element):
+        # Already parsed, e.g. a page moved out of a single-HTML book.
+        # A <body> is used as is; an <html> gives its <body> child.
+        if content.tag in BODY_TAGS:
+            return content
+        if content.tag in HTML_TAGS:
+            for child in content.iterchildren(*BODY_TAGS):
+                return child
+        raise ValueError('Content element must be a <body>, '
+                         'or an <html> with a <body>')
     if not content:  # Allow building empty models
         return etree.XML('<body xmlns="http://www.w3.org/1999/xhtml" />')
-    xml_parser = etree.XMLParser(ns_clean=True)
-    tree = etree.XML(content, xml_parser)
-    # Determine if we've been fed a full XHTML page, with a <body> tag:
+    else:
+        tree = etree.XML(content, content_parser())
+    # The <body> is either the root or, in a full XHTML page, a child of it.
+    if tree.tag in BODY_TAGS:
+        return tree
+    for child in tree.iterchildren(*BODY_TAGS):
+        return child
+    # Otherwise fall back to searching the whole document for it.
     bods = tree.xpath('//*[self::body|self::x:body]',
                       namespaces={'x': 'http://www.w3.org/1999/xhtml'})
     if bods:
@@ -91,10 +122,14 @@ def content_to_etree(content):
 
 def etree_to_content(etree_, strip_root_node=False):
     if strip_root_node:
-        return ''.join(utf8([
-            isinstance(node, (type(''), type(b''))) and
-            node or etree.tostring(node)
-            for node in etree_.xpath('node()')]))
+        # Serialize the root's child nodes (``node()``) in order. Each
+        # child is serialized with its tail, and the tail is then written
+        # again as the text node that follows it.
+        parts = [etree_.text or '']
+        for child in etree_:
+            parts.append(utf8(etree.tostring(child)))
+            parts.append(child.tail or '')
+        return ''.join(parts)
     return etree.tostring(etree_)
 
 
@@ -183,6 +218,9 @@ def flatten_to(model, flatten_filter):
 
 def _discover_uri_type(uri):
     """Given a ``uri``, determine if it is internal or external."""
+    if uri.startswith('#'):
+        # Fragment-only links within the book are the most common kind.
+        return INTERNAL_REFERENCE_TYPE
     parsed_uri = urlparse(uri)
     if not parsed_uri.netloc:
         if parsed_uri.scheme == 'data':
@@ -268,6 +306,32 @@ class Reference(object):
         self._uri_template = None
 
 
+# Reference finder paths. The media paths are searched in this order.
+ANCHOR_XPATH = etree.XPath('//*[self::a[@href]|self::x:a[@href]]',
+                           namespaces=XHTML_NS)
+MEDIA_XPATHS = tuple(
+    (etree.XPath(xpath, namespaces=ns), attr) for xpath, attr, ns in [
+        ['//img[@src]', 'src', None],
+        ['//img[@longdesc]', 'longdesc', None],
+        ['//audio[@src]', 'src', None],
+        ['//video[@src]', 'src', None],
+        ['//object[@data]', 'data', None],
+        ['//object/embed[@src]', 'src', None],
+        ['//source[@src]', 'src', None],
+        ['//span[@data-src]', 'data-src', None],
+        ['//span[@data-longdesc]', 'data-longdesc', None],
+        ['//x:img[@src]', 'src', XHTML_NS],
+        ['//x:img[@longdesc]', 'longdesc', XHTML_NS],
+        ['//x:audio[@src]', 'src', XHTML_NS],
+        ['//x:video[@src]', 'src', XHTML_NS],
+        ['//x:object[@data]', 'data', XHTML_NS],
+        ['//x:object/embed[@src]', 'src', XHTML_NS],
+        ['//x:source[@src]', 'src', XHTML_NS],
+        ['//x:span[@data-src]', 'data-src', XHTML_NS],
+        ['//x:span[@data-longdesc]', 'data-longdesc', XHTML_NS],
+        ])
+
+
 class HTMLReferenceFinder(object):
     """Find references within an HTML xml element tree."""
 
@@ -284,32 +348,11 @@ class HTMLReferenceFinder(object):
         return self.xml.xpath(xpath, namespaces=namespaces)
 
     def _anchors(self):
-        return self.apply_xpath('//*[self::a[@href]|self::x:a[@href]]',
-                                XHTML_NS)
+        return ANCHOR_XPATH(self.xml)
 
     def _media(self):
-        media_xpath = [
-                ['//img[@src]', 'src', None],
-                ['//img[@longdesc]', 'longdesc', None],
-                ['//audio[@src]', 'src', None],
-                ['//video[@src]', 'src', None],
-                ['//object[@data]', 'data', None],
-                ['//object/embed[@src]', 'src', None],
-                ['//source[@src]', 'src', None],
-                ['//span[@data-src]', 'data-src', None],
-                ['//span[@data-longdesc]', 'data-longdesc', None],
-                ['//x:img[@src]', 'src', XHTML_NS],
-                ['//x:img[@longdesc]', 'longdesc', XHTML_NS],
-                ['//x:audio[@src]', 'src', XHTML_NS],
-                ['//x:video[@src]', 'src', XHTML_NS],
-                ['//x:object[@data]', 'data', XHTML_NS],
-                ['//x:object/embed[@src]', 'src', XHTML_NS],
-                ['//x:source[@src]', 'src', XHTML_NS],
-                ['//x:span[@data-src]', 'data-src', XHTML_NS],
-                ['//x:span[@data-longdesc]', 'data-longdesc', XHTML_NS],
-                ]
-        for xpath, attr, ns in media_xpath:
-            for elm in self.apply_xpath(xpath, ns):
+        for xpath, attr in MEDIA_XPATHS:
+            for elm in xpath(self.xml):
                 yield elm, attr
 
 
@@ -323,11 +366,13 @@ class TranslucentBinder(MutableSequence):
     without being a persistent piece of data.
     """
     id = None
-    ident_hash = None
 
     def __init__(self, nodes=None, metadata=None,
                  title_overrides=None):
-        self._nodes = nodes or []
+        # Copy, so later changes to the caller's list can't desynchronize
+        # the nodes from their title overrides and index.
+        self._nodes = list(nodes) if nodes is not None else []
+        self._node_indexes = None
         self.metadata = utf8(metadata or {})
         if title_overrides is not None:
             if len(self._nodes) != len(title_overrides):
@@ -347,12 +392,26 @@ class TranslucentBinder(MutableSequence):
     def is_translucent(self):
         return self.__class__ is TranslucentBinder
 
+    def _index_of(self, node):
+        """Find the position of ``node``, using an index of the nodes that
+        is built on first use and discarded whenever the nodes change.
+        """
+        if self._node_indexes is None:
+            self._node_indexes = {}
+            for index, n in enumerate(self._nodes):
+                self._node_indexes.setdefault(id(n), index)
+        try:
+            return self._node_indexes[id(node)]
+        except KeyError:
+            # Not the same object, but it may still compare as equal.
+            return self._nodes.index(node)
+
     def set_title_for_node(self, node, title):
-        index = self._nodes.index(node)
+        index = self._index_of(node)
         self._title_overrides[index] = title
 
     def get_title_for_node(self, node):
-        index = self._nodes.index(node)
+        index = self._index_of(node)
         return self._title_overrides[index]
 
     # ABC methods for MutableSequence
@@ -361,10 +420,12 @@ class TranslucentBinder(MutableSequence):
 
     def __setitem__(self, i, v):
         self._nodes[i] = v
+        self._node_indexes = None
 
     def __delitem__(self, i):
         del self._nodes[i]
         del self._title_overrides[i]
+        self._node_indexes = None
 
     def __len__(self):
         return len(self._nodes)
@@ -372,6 +433,26 @@ class TranslucentBinder(MutableSequence):
     def insert(self, i, v):
         self._nodes.insert(i, v)
         self._title_overrides.insert(i, None)
+        self._node_indexes = None
+
+    # Overrides of the MutableSequence mixins, which would otherwise go
+    # through ``__getitem__`` and ``insert`` one index at a time.
+    def __iter__(self):
+        return iter(self._nodes)
+
+    def __contains__(self, v):
+        return v in self._nodes
+
+    def append(self, v):
+        self._nodes.append(v)
+        self._title_overrides.append(None)
+        self._node_indexes = None
+
+    def extend(self, values):
+        values = list(values)
+        self._nodes.extend(values)
+        self._title_overrides.extend([None] * len(values))
+        self._node_indexes = None
 
 
 class Binder(TranslucentBinder):
@@ -431,10 +512,9 @@ class Document(object):
                  reference_resolver=None):
         self._xml = None
         if hasattr(data, 'read'):
-            self.content = utf8(data.read())
-        else:
-            self.content = utf8(data)
-        self._references = _parse_references(self._xml)
+            data = data.read()
+        # Encoded data is handed straight to the parser, which reads bytes.
+        self.content = data
         self.metadata = utf8(metadata or {})
         self.resources = resources or []
         self.id = id
@@ -448,11 +528,12 @@ class Document(object):
 
     def _content__set(self, value):
         self._xml = content_to_etree(value)
-        # reload the references after a content update
-        self._references = _parse_references(self._xml)
+        # reload the references, on next access, after a content update
+        self._references = None
 
     def _content__del(self):
         self._xml = content_to_etree('')
+        self._references = None
 
     content = property(_content__get,
                        _content__set,
@@ -510,9 +591,10 @@ class Document(object):
     def references(self):
         """Reference points in the document.
         These could be resources, other documents, external links, etc.
+        The references are parsed from the content on first access.
         """
         if self._references is None:
-            return []
+            self._references = _parse_references(self._xml)
         return self._references
 
 
@@ -12,7 +12,6 @@ from io import StringIO
 import os
 import tempfile
 import shutil
-import sys
 import unittest
 import zipfile
 
@@ -363,3 +363,77 @@ Pointer.
             '<div data-type="page" id="apple">\n<div>')
 
         self.assertRaises(IndexError, adapt_single_html, html)
+
+    def test_parsed_tree_is_left_unchanged(self):
+        from ..adapters import adapt_single_html
+        from ..models import model_to_tree
+
+        page_path = os.path.join(TEST_DATA_DIR, 'desserts-single-page.xhtml')
+        html = etree.parse(page_path)
+        original = etree.tostring(html)
+
+        first = adapt_single_html(html)
+        self.assertEqual(original, etree.tostring(html))
+        second = adapt_single_html(html)
+
+        self.assertEqual(model_to_tree(first), model_to_tree(second))
+        self.assertEqual(first[0][0].content, second[0][0].content)
+
+    @mock.patch('cnxepub.adapters.logger')
+    def test_missing_chapter_title(self, logger):
+        from ..adapters import adapt_single_html
+
+        page_path = os.path.join(TEST_DATA_DIR,
+                                 'collated-desserts-single-page.xhtml')
+
+        with open(page_path, 'r') as f:
+            html = f.read()
+
+        html = html.replace('<h1 data-type="document-title">Fruity</h1>', '')
+
+        with self.assertRaises(IndexError) as caught:
+            adapt_single_html(html)
+        self.assertIn('has no document-title', str(caught.exception))
+
+    def test_missing_book_metadata(self):
+        from ..adapters import adapt_single_html
+
+        html = '''\
+<html xmlns="http://www.w3.org/1999/xhtml">
+  <body><div data-type="page" id="apple"><p>Apple</p></div></body>
+</html>'''
+
+        with self.assertRaises(ValueError) as caught:
+            adapt_single_html(html)
+        self.assertEqual('single-HTML has no metadata section',
+                         str(caught.exception))
+
+    def test_missing_body(self):
+        from ..adapters import adapt_single_html
+
+        page_path = os.path.join(TEST_DATA_DIR,
+                                 'collated-desserts-single-page.xhtml')
+
+        with open(page_path, 'r') as f:
+            html = f.read()
+
+        html = re.sub(r'<(/?)body\b', r'<\1div', html)
+
+        with self.assertRaises(ValueError) as caught:
+            adapt_single_html(html)
+        self.assertEqual('single-HTML has no body', str(caught.exception))
+
+    @mock.patch('cnxepub.adapters.logger')
+    def test_nav_shorter_than_content(self, logger):
+        from ..adapters import adapt_single_html
+
+        page_path = os.path.join(TEST_DATA_DIR,
+                                 'collated-desserts-single-page.xhtml')
+
+        with open(page_path, 'r') as f:
+            html = f.read()
+
+        html = html.replace('<li><a href="#page_extra">Extra Stuff</a></li>',
+                            '')
+
+        self.assertRaises(IndexError, adapt_single_html, html)
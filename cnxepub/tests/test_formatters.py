@@ -788,6 +788,21 @@ class HTMLFormatterTestCase(unittest.TestCase):
         formatted = str(HTMLFormatter(document, generate_ids=True))
         self.assertIn(expected_content, formatted)
 
+    def test_document_to_etree(self):
+        from ..models import Document
+        from ..formatters import HTMLFormatter
+
+        document = Document(
+            'document', u'<body><p>コンテンツ...</p></body>',
+            metadata=self.base_metadata.copy())
+        formatter = HTMLFormatter(document)
+
+        self.root = formatter.to_etree()
+        self.assertEqual(
+            u'コンテンツ...', self.xpath('//xhtml:body/xhtml:p/text()')[0])
+        self.assertEqual(
+            u'タイトル', self.xpath('//xhtml:head/xhtml:title/text()')[0])
+
 
 @mock.patch('mimetypes.guess_extension', last_extension)
 class SingleHTMLFormatterTestCase(unittest.TestCase):
@@ -948,6 +963,34 @@ class SingleHTMLFormatterTestCase(unittest.TestCase):
                 html,
                 unicode(SingleHTMLFormatter(self.desserts)).encode('utf-8'))
 
+    def test_binder_with_mathml(self):
+        from ..models import Binder, TranslucentBinder, Document
+        from ..formatters import SingleHTMLFormatter
+
+        contents = io.BytesIO(b"""\
+<body xmlns:epub="http://www.idpf.org/2007/ops">
+<p epub:type="note">Inline
+  <math xmlns="http://www.w3.org/1998/Math/MathML"><mi>x</mi></math>
+</p>
+<m:math xmlns:m="http://www.w3.org/1998/Math/MathML"><m:mn>2</m:mn></m:math>
+</body>
+""")
+        metadata = self.base_metadata.copy()
+        metadata['title'] = 'Math'
+        math = Document('math', contents, metadata=metadata)
+        chapter = TranslucentBinder([math], metadata={'title': 'Numbers'})
+        binder = Binder('book', nodes=[chapter],
+                        metadata=self.base_metadata.copy())
+
+        with open(os.path.join(TEST_DATA_DIR,
+                               'mathml-single-page.xhtml'), 'rb') as f:
+            expected_content = f.read()
+
+        # The namespace declarations, and their order, on the <html> tag
+        # must be as they were when each rendering was reparsed.
+        self.assertEqual(expected_content,
+                         bytes(SingleHTMLFormatter(binder)))
+
     @mock.patch('requests.get', mocked_requests_get)
     def test_includes_callback(self):
         from ..formatters import SingleHTMLFormatter
@@ -1081,6 +1124,36 @@ class FixNamespacesTestCase(unittest.TestCase):
         self.assertMultiLineEqual(expected_content, xmlpp(actual).decode('utf-8'))
 
 
+class TreeToHtmlTestCase(unittest.TestCase):
+    def test_titles(self):
+        from ..formatters import tree_to_html
+
+        tree = {
+            'id': 'book@1',
+            'title': 'Book',
+            'contents': [
+                {'id': 'subcol', 'shortId': None,
+                 'title': 'Plain & <em>marked up</em>',
+                 'contents': [
+                     {'id': 'page@1', 'shortId': 'pg@1',
+                      'title': 'Plain title > text'},
+                     {'id': 'other@1', 'shortId': None, 'title': ' '},
+                     ]},
+                ],
+            }
+
+        actual = tree_to_html(tree, {'page@1': '.xhtml'})
+
+        self.assertEqual(
+            b'<nav id="toc"><ol>'
+            b'<li><span>Plain &amp; <em>marked up</em></span><ol>'
+            b'<li cnx-archive-uri="page@1" cnx-archive-shortid="pg@1">'
+            b'<a href="#page_page">Plain title &gt; text</a></li>'
+            b'<li cnx-archive-uri="other@1"><span/></li>'
+            b'</ol></li></ol></nav>',
+            actual)
+
+
 class ExerciseAnnotationTestCase(unittest.TestCase):
     def format_html(self, html):
         return xmlpp(html.encode('utf-8')).split(b'\n')
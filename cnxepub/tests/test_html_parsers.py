@@ -66,3 +66,90 @@ class HTMLParsingTestCase(unittest.TestCase):
             'slug': None,
             }
         self.assertEqual(metadata, expected_metadata)
+
+    def test_metadata_parsing_people_without_ids(self):
+        """Verify people without an id keep their document order."""
+        html = etree.fromstring("""\
+<div xmlns="http://www.w3.org/1999/xhtml" data-type="metadata">
+  <h1 data-type="document-title">Untitled</h1>
+  <span data-type="author">Ann</span>
+  <span data-type="author">Bob</span>
+</div>""")
+        from ..html_parsers import parse_metadata
+        metadata = parse_metadata(html)
+
+        self.assertEqual(
+            [a['name'] for a in metadata['authors']], ['Ann', 'Bob'])
+
+    def test_navigation_parsing(self):
+        """Verify the parsing of a nested navigation tree."""
+        html_doc_filepath = os.path.join(TEST_DATA_DIR, 'nav-tree.xhtml')
+        from ..html_parsers import parse_navigation_html_to_tree
+        with open(html_doc_filepath, 'r') as fb:
+            html = etree.parse(fb)
+            tree = parse_navigation_html_to_tree(html, 'book')
+
+        def page(id, title):
+            return {'id': '#page_{}'.format(id), 'shortid': None,
+                    'title': title}
+
+        def subcol(title, *contents):
+            return {'id': 'subcol', 'shortId': None, 'title': title,
+                    'contents': list(contents)}
+
+        expected_tree = {
+            'id': 'book',
+            'title': 'Document One of Infinity',
+            'contents': [
+                subcol('Part One',
+                       subcol('Chapter One', page(
+                           'e78d4f90-e078-49d2-beac-e95e8be70667',
+                           'Document One')),
+                       subcol('Chapter Two', page(
+                           '3c448dc6-d5f5-43d5-8df7-fe27d462bd3a',
+                           'Document Two'))),
+                subcol('Part Two',
+                       subcol('Chapter Three', page(
+                           'ad17c39c-d606-4441-b987-54448020bb40',
+                           'Document Three'))),
+                subcol('Part Three',
+                       subcol('Chapter Four', page(
+                           '7c52af05-05b1-4761-aa4c-b17b0197dc6d',
+                           'Document Four'))),
+                ],
+            }
+        self.assertEqual(expected_tree, tree)
+
+    def test_metadata_parsing_people_display_seq(self):
+        """Verify people are ordered numerically by their display-seq."""
+        html = etree.fromstring("""\
+<div xmlns="http://www.w3.org/1999/xhtml" data-type="metadata">
+  <h1 data-type="document-title">Untitled</h1>
+  <span data-type="author" id="author-1">Ann</span>
+  <meta refines="#author-1" property="display-seq" content="10" />
+  <span data-type="author" id="author-2">Bob</span>
+  <meta refines="#author-2" property="display-seq" content="2" />
+  <span data-type="author" id="author-3">Cat</span>
+</div>""")
+        from ..html_parsers import parse_metadata
+        metadata = parse_metadata(html)
+
+        self.assertEqual(
+            [a['name'] for a in metadata['authors']], ['Cat', 'Bob', 'Ann'])
+
+    def test_metadata_parsing_people_bad_display_seq(self):
+        """Verify a non-numeric display-seq is treated as missing."""
+        html = etree.fromstring("""\
+<div xmlns="http://www.w3.org/1999/xhtml" data-type="metadata">
+  <h1 data-type="document-title">Untitled</h1>
+  <span data-type="author" id="author-1">Ann</span>
+  <meta refines="#author-1" property="display-seq" content="2" />
+  <span data-type="author" id="author-2">Bob</span>
+  <meta refines="#author-2" property="display-seq" content="first" />
+  <span data-type="author" id="author-3">Cat</span>
+</div>""")
+        from ..html_parsers import parse_metadata
+        metadata = parse_metadata(html)
+
+        self.assertEqual(
+            [a['name'] for a in metadata['authors']], ['Bob', 'Cat', 'Ann'])
@@ -399,3 +399,79 @@ class ModelBehaviorTestCase(unittest.TestCase):
         document = Document('document', metadata['content'])
         self.assertTrue(b'To demonstrate the potential of online publishing'
                         in document.content)
+
+    def test_document_from_encoded_file(self):
+        content = u"""\
+<?xml version="1.0" encoding="UTF-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml">
+<body><p>Hüvasti, maailm.</p></body>
+</html>""".encode('utf-8')
+
+        from ..models import Document
+        document = Document('document', io.BytesIO(content))
+        self.assertTrue(b'<p>H&#252;vasti, maailm.</p>' in document.content)
+
+    def test_document_from_element(self):
+        from lxml import etree
+        body = etree.fromstring(
+            '<body xmlns="http://www.w3.org/1999/xhtml">'
+            '<a href="#p1">link</a></body>')
+
+        from ..models import Document
+        document = Document('document', body)
+        self.assertIs(document._xml, body)
+        self.assertEqual(['#p1'], [ref.uri for ref in document.references])
+
+    def test_document_from_nested_element(self):
+        from lxml import etree
+        html = etree.fromstring(
+            '<html xmlns="http://www.w3.org/1999/xhtml"><body>'
+            '<div id="a"><p>a</p></div><div id="b"/></body></html>')
+
+        from ..models import Document
+        with self.assertRaises(ValueError):
+            Document('document', html[0][0])
+
+        document = Document('document', html)
+        self.assertIs(document._xml, html[0])
+
+    def test_binder_title_overrides_follow_nodes(self):
+        from ..models import TranslucentBinder, DocumentPointer
+        nodes = [DocumentPointer(x) for x in ('a@1', 'b@1', 'c@1')]
+        binder = TranslucentBinder(nodes, title_overrides=['A', 'B', 'C'])
+        removed, last = nodes[0], nodes[2]
+        self.assertEqual(binder.get_title_for_node(last), 'C')
+
+        del binder[0]
+        binder.insert(1, DocumentPointer('d@1'))
+        binder.set_title_for_node(binder[1], 'D')
+
+        self.assertEqual(
+            [binder.get_title_for_node(n) for n in binder],
+            ['B', 'D', 'C'])
+        with self.assertRaises(ValueError):
+            binder.get_title_for_node(removed)
+
+    def test_binder_does_not_share_given_nodes(self):
+        from ..models import TranslucentBinder, DocumentPointer
+        nodes = [DocumentPointer('a@1')]
+        binder = TranslucentBinder(nodes, title_overrides=['A'])
+
+        nodes.append(DocumentPointer('b@1'))
+        binder.append(DocumentPointer('c@1'))
+
+        self.assertEqual(len(nodes), 2)
+        self.assertEqual([n.id for n in binder], ['a@1', 'c@1'])
+        self.assertEqual(binder.get_title_for_node(binder[0]), 'A')
+
+    def test_binder_extend(self):
+        from ..models import TranslucentBinder, DocumentPointer
+        binder = TranslucentBinder([DocumentPointer('a@1')],
+                                   title_overrides=['A'])
+        binder.extend(DocumentPointer(x) for x in ('b@1', 'c@1'))
+        binder.set_title_for_node(binder[2], 'C')
+
+        self.assertEqual([n.id for n in binder], ['a@1', 'b@1', 'c@1'])
+        self.assertEqual(
+            [binder.get_title_for_node(n) for n in binder],
+            ['A', None, 'C'])
@@ -7,15 +7,20 @@
 # ###
 """Various standalone utility functions that provide specific outcomes"""
 import re
+import threading
 from concurrent.futures import ThreadPoolExecutor
 from lxml import etree
 
 
 __all__ = (
     'squash_xml_to_text',
+    'thread_local_parser',
 )
 
 
+_local = threading.local()
+
+
 def squash_xml_to_text(elm, remove_namespaces=False):
     """Squash the given XML element (as `elm`) to a text containing XML.
     The outer most element/tag will be removed, but inner elements will
@@ -49,3 +54,25 @@ def squash_xml_to_text(elm, remove_namespaces=False):
     # Join the results and strip any surrounding whitespace
     result = u''.join(result).strip()
     return result
+
+
+def thread_local_parser(**options):
+    """Return an ``etree.XMLParser`` made with the given ``options`` for the
+    current thread. lxml lets only one thread at a time parse with a given
+    parser, so, like lxml's own default parser, one is kept per thread.
+
+    :param options: keyword arguments for :class:`lxml.etree.XMLParser`
+    :return: the current thread's parser for these options
+    :rtype: :class:`lxml.etree.XMLParser`
+
+    """
+    try:
+        parsers = _local.parsers
+    except AttributeError:
+        parsers = _local.parsers = {}
+    key = tuple(sorted(options.items()))
+    try:
+        return parsers[key]
+    except KeyError:
+        parser = parsers[key] = etree.XMLParser(**options)
+        return parser